@@ -4,6 +4,7 @@ Demo Script - API-based Recording System
 모듈화된 구조를 사용한 간소화된 메인 스크립트
 """
 
+import logging
 import sys
 import time
 import warnings
@@ -32,7 +33,7 @@ API_PORT = 5000
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 DAM_SCRIPT = PROJECT_ROOT / "src" / "dam_video_with_sam2.py"
 CAPTURE_DIR = PROJECT_ROOT / "captures"
-LOG_FILE = PROJECT_ROOT / "action_log.txt"
+LOG_FILE = PROJECT_ROOT / "action_log.jsonl"
 
 # -----------------------------------------------------------------------------
 # Global Variables & Flask App
@@ -145,6 +146,9 @@ def process_external_signals():
 def main():
     global camera_manager, dam_analyzer, log_manager, recording_active
     
+    # 모듈 로그 출력 (DAMAnalyzer / LogManager)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     # 환경 체크
     try:
         import sam2, torch
@@ -163,7 +163,7 @@ setup(
         "ultralytics>=8.3.131",
         "hydra-core>=1.3.2",
         "iopath>=0.1.10",
-        "transformers>=4.37.0",
+        "transformers>=4.49.0",
         "accelerate>=0.20.0",
         "sentencepiece>=0.1.99",
         "protobuf>=3.20.0",
@@ -192,6 +192,13 @@ setup(
             "pycuda>=2024.1",
             "onnx>=1.15.0",
             "onnxruntime-gpu>=1.16.0",
-        ]
+        ],
+        "quantization": [
+            "bitsandbytes>=0.43.0",
+        ],
+        "logging": [
+            "orjson>=3.9.0",
+            "zstandard>=0.22.0",
+        ],
     },
 )
\ No newline at end of file
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+CUDA Environment Module
+CUDA 초기화 전에 적용해야 하는 환경 설정을 담당
+"""
+
+import os
+
+# expandable segments로 클립마다 반복되는 vision/KV 할당에서 캐싱 할당자 단편화를 줄임
+CUDA_ALLOC_CONF = "expandable_segments:True,max_split_size_mb:128"
+
+
+def set_cuda_alloc_conf():
+    """CUDA 할당자 설정 적용 (CUDA 초기화 전에 호출, 환경에 PYTORCH_CUDA_ALLOC_CONF가 있으면 그대로 사용)"""
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", CUDA_ALLOC_CONF)
@@ -134,6 +134,14 @@ class DescribeAnythingModel(nn.Module):
 
         return prompt, conv
 
+    def get_prompt_input_ids(self, query):
+        """
+        Tokenizes the conversation-wrapped `query` once. The result can be passed as `input_ids` to `get_description` and
+        `get_descriptions_batch` to skip tokenization when the same query is used for many requests.
+        """
+        prompt, _ = self.get_prompt(query)
+        return tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").to(self.model.device)
+
     @staticmethod
     def mask_to_box(mask_np):
         mask_coords = np.argwhere(mask_np)
@@ -200,7 +208,7 @@ class DescribeAnythingModel(nn.Module):
         info = dict(mask_np=cropped_mask_np)
         return cropped_pil_img, info
 
-    def get_description(self, image_pil, mask_pil, query, streaming=False, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, **kwargs):
+    def get_description(self, image_pil, mask_pil, query, streaming=False, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, input_ids=None, **kwargs):
         # kwargs is passed to generation_kwargs: https://huggingface.co/docs/transformers/main/en/main_classes/text_generation#transformers.GenerationConfig
         
         prompt, conv = self.get_prompt(query)
@@ -211,33 +219,34 @@ class DescribeAnythingModel(nn.Module):
         else:
             image_pils = image_pil
             mask_pils = mask_pil
-        description = self.get_description_from_prompt(image_pils, mask_pils, prompt, conv, streaming=streaming, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, **kwargs)
+        description = self.get_description_from_prompt(image_pils, mask_pils, prompt, conv, streaming=streaming, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, input_ids=input_ids, **kwargs)
         
         return description
 
     def get_image_tensor(self, image_pil, mask_pil, crop_mode, crop_mode2):
         # the pil has True/False (if the value is non-zero, then we treat it as True)
         mask_np = (np.asarray(mask_pil) > 0).astype(np.uint8)
+        dtype = self.model.get_vision_tower().dtype
         images_tensor, image_info = process_image(image_pil, self.model.config, None, pil_preprocess_fn=lambda pil_img: self.crop_image(image_pil, mask_np=mask_np, crop_mode=crop_mode))
-        images_tensor = images_tensor[None].to(self.model.device, dtype=torch.float16)
+        images_tensor = images_tensor[None].to(self.model.device, dtype=dtype)
 
         mask_np = image_info["mask_np"]
         mask_pil = Image.fromarray(mask_np * 255)
         
         masks_tensor = process_image(mask_pil, self.model.config, None)
-        masks_tensor = masks_tensor[None].to(self.model.device, dtype=torch.float16)
+        masks_tensor = masks_tensor[None].to(self.model.device, dtype=dtype)
         
         images_tensor = torch.cat((images_tensor, masks_tensor[:, :1, ...]), dim=1)
 
         if crop_mode2 is not None:
             images_tensor2, image_info2 = process_image(image_pil, self.model.config, None, pil_preprocess_fn=lambda pil_img: self.crop_image(pil_img, mask_np=mask_np, crop_mode=crop_mode2))
-            images_tensor2 = images_tensor2[None].to(self.model.device, dtype=torch.float16)
+            images_tensor2 = images_tensor2[None].to(self.model.device, dtype=dtype)
 
             mask_np2 = image_info2["mask_np"]
             mask_pil2 = Image.fromarray(mask_np2 * 255)
             
             masks_tensor2 = process_image(mask_pil2, self.model.config, None)
-            masks_tensor2 = masks_tensor2[None].to(self.model.device, dtype=torch.float16)
+            masks_tensor2 = masks_tensor2[None].to(self.model.device, dtype=dtype)
 
             images_tensor2 = torch.cat((images_tensor2, masks_tensor2[:, :1, ...]), dim=1)
         else:
@@ -245,41 +254,23 @@ class DescribeAnythingModel(nn.Module):
             
         return torch.cat((images_tensor, images_tensor2), dim=1) if images_tensor2 is not None else images_tensor
     
-    def get_description_from_prompt(self, image_pils, mask_pils, prompt, conv, streaming=False, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, **kwargs):
+    def get_description_from_prompt(self, image_pils, mask_pils, prompt, conv, streaming=False, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, input_ids=None, **kwargs):
         if streaming:
-            return self.get_description_from_prompt_iterator(image_pils, mask_pils, prompt, conv, streaming=True, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, **kwargs)
+            return self.get_description_from_prompt_iterator(image_pils, mask_pils, prompt, conv, streaming=True, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, input_ids=input_ids, **kwargs)
         else:
             # If streaming is False, there will be only one output
-            output = self.get_description_from_prompt_iterator(image_pils, mask_pils, prompt, conv, streaming=False, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, **kwargs)
+            output = self.get_description_from_prompt_iterator(image_pils, mask_pils, prompt, conv, streaming=False, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, input_ids=input_ids, **kwargs)
             return next(output)
 
-    def get_description_from_prompt_iterator(self, image_pils, mask_pils, prompt, conv, streaming=False, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, **kwargs):
+    def get_description_from_prompt_iterator(self, image_pils, mask_pils, prompt, conv, streaming=False, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, input_ids=None, **kwargs):
         crop_mode, crop_mode2 = self.prompt_mode.split("+")
         assert crop_mode == "full", "Current prompt only supports first crop as full (non-cropped). If you need other specifications, please update the prompt."
         
         assert len(image_pils) == len(mask_pils), f"image_pils and mask_pils must have the same length. Got {len(image_pils)} and {len(mask_pils)}."
         image_tensors = [self.get_image_tensor(image_pil, mask_pil, crop_mode=crop_mode, crop_mode2=crop_mode2) for image_pil, mask_pil in zip(image_pils, mask_pils)]
-        
-        input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).cuda()
-
-        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-        keywords = [stop_str]
-        stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
 
         streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True) if streaming else None
-        generation_kwargs = dict(
-            input_ids=input_ids,
-            images=image_tensors,
-            do_sample=True if temperature > 0 else False,
-            use_cache=True,
-            stopping_criteria=[stopping_criteria],
-            streamer=streamer,
-            temperature=temperature,
-            top_p=top_p,
-            num_beams=num_beams,
-            max_new_tokens=max_new_tokens,
-            **kwargs
-        )
+        generation_kwargs, stop_str = self.get_generation_kwargs(prompt, conv, image_tensors, batch_size=1, input_ids=input_ids, streamer=streamer, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, **kwargs)
 
         if streaming:
             thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
@@ -298,10 +289,65 @@ class DescribeAnythingModel(nn.Module):
             with torch.inference_mode():
                 output_ids = self.model.generate(**generation_kwargs)
 
-            outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0]
-            outputs = outputs.strip()
-            if outputs.endswith(stop_str):
-                outputs = outputs[: -len(stop_str)]
+            yield self.decode_outputs(output_ids, stop_str)[0]
+
+    def get_generation_kwargs(self, prompt, conv, image_tensors, batch_size=1, input_ids=None, streamer=None, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, **kwargs):
+        """
+        Builds the `generate` kwargs shared by the single and batched paths, with `batch_size` copies of the prompt.
+        Returns the kwargs and the stop string that `decode_outputs` truncates at.
+        """
+        # `input_ids` is the pre-tokenized prompt from `get_prompt_input_ids`, if the caller has one
+        if input_ids is None:
+            input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt")
+        input_ids = input_ids.unsqueeze(0).repeat(batch_size, 1).cuda()
+
+        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+        stopping_criteria = KeywordsStoppingCriteria([stop_str], self.tokenizer, input_ids)
+
+        generation_kwargs = dict(
+            input_ids=input_ids,
+            images=image_tensors,
+            do_sample=True if temperature > 0 else False,
+            use_cache=True,
+            stopping_criteria=[stopping_criteria],
+            streamer=streamer,
+            temperature=temperature,
+            top_p=top_p,
+            num_beams=num_beams,
+            max_new_tokens=max_new_tokens,
+            **kwargs
+        )
+        return generation_kwargs, stop_str
+
+    def decode_outputs(self, output_ids, stop_str):
+        """Decodes `generate` output ids into one description per sequence, cut at the first `stop_str`."""
+        descriptions = []
+        for outputs in self.tokenizer.batch_decode(output_ids, skip_special_tokens=True):
             outputs = outputs.strip()
+            if stop_str in outputs:
+                outputs = outputs[: outputs.find(stop_str)]
+            descriptions.append(outputs.strip())
+        return descriptions
+
+    def get_descriptions_batch(self, image_pils, mask_pils_per_object, query, temperature=0.2, top_p=0.5, num_beams=1, max_new_tokens=512, input_ids=None, **kwargs):
+        """
+        Describes several masked regions of the same frames with a single batched `generate` call.
+        `mask_pils_per_object` holds one list of masks (aligned with `image_pils`) per object, and one description is returned per object.
+        """
+        prompt, conv = self.get_prompt(query)
+        crop_mode, crop_mode2 = self.prompt_mode.split("+")
+        assert crop_mode == "full", "Current prompt only supports first crop as full (non-cropped). If you need other specifications, please update the prompt."
+
+        # The mask is an input channel of the vision tower, so every object needs its own image tensors.
+        # They are laid out object by object to match the order in which the batch consumes <image> tokens.
+        image_tensors = []
+        for mask_pils in mask_pils_per_object:
+            assert len(image_pils) == len(mask_pils), f"image_pils and mask_pils must have the same length. Got {len(image_pils)} and {len(mask_pils)}."
+            image_tensors.extend(self.get_image_tensor(image_pil, mask_pil, crop_mode=crop_mode, crop_mode2=crop_mode2) for image_pil, mask_pil in zip(image_pils, mask_pils))
+
+        generation_kwargs, stop_str = self.get_generation_kwargs(prompt, conv, image_tensors, batch_size=len(mask_pils_per_object), input_ids=input_ids, temperature=temperature, top_p=top_p, num_beams=num_beams, max_new_tokens=max_new_tokens, **kwargs)
+
+        with torch.inference_mode():
+            output_ids = self.model.generate(**generation_kwargs)
 
-            yield outputs
+        return self.decode_outputs(output_ids, stop_str)
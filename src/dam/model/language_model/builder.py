@@ -56,6 +56,24 @@ def has_tokenizer(path):
     return False
 
 
+def get_default_torch_dtype():
+    """bf16 on GPUs with native bf16 support, fp16 otherwise (pre-Ampere GPUs and CPU)."""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def get_default_attn_implementation():
+    """FlashAttention-2 on Ampere or newer GPUs when `flash_attn` is installed, SDPA otherwise."""
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        try:
+            import flash_attn  # noqa
+            return "flash_attention_2"
+        except ImportError:
+            pass
+    return "sdpa"
+
+
 def context_length_extension(config):
     orig_ctx_len = getattr(config, "max_position_embeddings", None)
     model_max_length = getattr(config, "model_max_length", None)
@@ -16,20 +16,34 @@
 
 
 from typing import List, Optional, Tuple, Union
+from collections import OrderedDict
+import copy
 import os
+import threading
 import torch
 
 from transformers import (
     AutoConfig,
     AutoModel,
+    BitsAndBytesConfig,
     PretrainedConfig,
     PreTrainedModel,
+    StaticCache,
 )
 
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from ..llava_arch import LlavaMetaModel, LlavaMetaForCausalLM
 from ..configuration_llava import LlavaConfig
+from ..constants import IMAGE_TOKEN_INDEX
 from ..mm_utils import get_model_name_from_path, tokenizer_image_token
+from .builder import get_default_attn_implementation, get_default_torch_dtype
+
+# Number of distinct text prefixes whose KV cache is kept for reuse in `generate`
+PREFIX_CACHE_SIZE = 8
+# With a compiled LLM, prompts are left-padded to a multiple of this length so CUDA graphs are reused
+COMPILE_SEQ_BUCKET = 64
+# The static KV cache length is rounded up to a multiple of this so small prompt changes do not reallocate it
+STATIC_CACHE_BUCKET = 256
 
 class LlavaLlamaConfig(LlavaConfig):
     model_type = "llava_llama"
@@ -45,6 +59,13 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
         super().__init__(config)
         self.dam_model = None
         self.pretrained_model_name_or_path = None
+        self._prefix_cache = OrderedDict()
+        self._llm_compiled = False
+        # Static KV cache reused across `generate` calls and its (batch size, max length); the lock is held by the
+        # `generate` call currently decoding into it
+        self._static_cache = None
+        self._static_cache_shape = None
+        self._static_cache_lock = threading.Lock()
         self.init_vlm(config=config, *args, **kwargs)
 
     @classmethod
@@ -60,15 +81,36 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
         token: Optional[Union[str, bool]] = None,
         revision: str = "main",
         use_safetensors: bool = None,
-        torch_dtype: Optional[Union[str, torch.dtype]] = torch.float16,
+        torch_dtype: Optional[Union[str, torch.dtype]] = None,
+        attn_implementation: Optional[str] = None,
+        load_in_4bit: bool = False,
+        compile_llm: bool = False,
         init_dam: bool = False,
         # conv_mode and prompt_mode are only used by `init_dam` in `from_pretrained` if `init_dam` is set to True
         conv_mode: str = "v1",
         prompt_mode: str = "full+focal_crop",
         **kwargs,
     ):
-        if torch_dtype:
-            config.model_dtype = str(torch_dtype)
+        # bf16 when the GPU supports it natively, fp16 otherwise
+        if torch_dtype is None:
+            torch_dtype = get_default_torch_dtype()
+        config.model_dtype = str(torch_dtype)
+        # FlashAttention-2 when the GPU supports it; forwarded to the inner LLM config by `build_llm_and_tokenizer`.
+        # A compiled LLM decodes into a static KV cache, which FlashAttention-2 does not support, so it defaults to SDPA.
+        if attn_implementation is None:
+            attn_implementation = "sdpa" if compile_llm else get_default_attn_implementation()
+        elif compile_llm and attn_implementation == "flash_attention_2":
+            raise ValueError("`compile_llm` uses a static KV cache, which is not supported with flash_attention_2.")
+        config._attn_implementation = attn_implementation
+        kwargs["attn_implementation"] = attn_implementation
+        # Weight-only NF4 for the LLM only; the vision tower and projector are built without `quantization_config`
+        if load_in_4bit:
+            kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch_dtype,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+            )
         if hasattr(cls, "load_pretrained"):
             obj = cls.load_pretrained(pretrained_model_name_or_path,
                                        *model_args, config=config, cache_dir=cache_dir, ignore_mismatched_sizes=ignore_mismatched_sizes, force_download=force_download, local_files_only=local_files_only, token=token,
@@ -79,6 +121,8 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
                                                       *model_args, config=config, cache_dir=cache_dir, ignore_mismatched_sizes=ignore_mismatched_sizes, force_download=force_download, local_files_only=local_files_only, token=token,
                                                       revision=revision, use_safetensors=use_safetensors, **kwargs)
         obj.pretrained_model_name_or_path = pretrained_model_name_or_path
+        if compile_llm:
+            obj.compile_llm()
         
         # `init_dam` is used to initialize a `DescribeAnythingModel` object in a `LlavaLlamaModel` in DAM. If you initialize `DescribeAnythingModel` on your own outside, then you don't have to use this option.
         # This is very useful if you use `from_pretrained` with remote code execution and don't want to put implementation for `DescribeAnythingModel` class in your codebase.
@@ -101,7 +145,8 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
-        self.freezed_module_patch()
+        if self.training:
+            self.freezed_module_patch()
         if inputs_embeds is None:
             (
                 input_ids,
@@ -156,6 +201,96 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
         )
         return outputs
 
+    def compile_llm(self):
+        """
+        Makes `generate` decode into the static KV cache, for which transformers compiles the LLM decode step with
+        torch.compile(mode="reduce-overhead") so it replays CUDA graphs. Only the LLM is compiled; the vision tower and
+        projector stay eager.
+        """
+        from transformers.generation import CompileConfig
+
+        llm = self.get_llm()
+        if llm.config._attn_implementation == "flash_attention_2":
+            raise ValueError("`compile_llm` uses a static KV cache, which is not supported with flash_attention_2.")
+        # Use the compile built into `generate` rather than wrapping `llm.forward`, which would be compiled twice
+        llm.generation_config.compile_config = CompileConfig(fullgraph=False, dynamic=False, mode="reduce-overhead")
+        self._llm_compiled = True
+
+    @staticmethod
+    def pad_to_bucket(inputs_embeds, attention_mask):
+        """Left-pads `inputs_embeds` (and the attention mask) to a multiple of COMPILE_SEQ_BUCKET."""
+        batch_size, seq_len, _ = inputs_embeds.shape
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, seq_len), dtype=torch.long, device=inputs_embeds.device)
+        pad_len = -seq_len % COMPILE_SEQ_BUCKET
+        if pad_len == 0:
+            return inputs_embeds, attention_mask
+        inputs_embeds = torch.cat((inputs_embeds.new_zeros((batch_size, pad_len, inputs_embeds.shape[2])), inputs_embeds), dim=1)
+        attention_mask = torch.cat((attention_mask.new_zeros((batch_size, pad_len)), attention_mask), dim=1)
+        return inputs_embeds, attention_mask
+
+    def build_static_cache(self, batch_size, max_cache_len):
+        return StaticCache(
+            config=self.get_llm().config,
+            max_batch_size=batch_size,
+            max_cache_len=max_cache_len,
+            device=self.device,
+            dtype=self.dtype,
+        )
+
+    def get_static_cache(self, batch_size, max_cache_len, shared=True):
+        """
+        Returns a static KV cache for `batch_size` sequences of up to `max_cache_len` tokens. The shared cache is kept across
+        calls and reset in place; it is only reallocated when the batch size changes or a longer sequence is needed.
+        The caller must hold `_static_cache_lock` for the shared cache; with `shared=False` a new, unkept cache is returned.
+        """
+        max_cache_len = -(-max_cache_len // STATIC_CACHE_BUCKET) * STATIC_CACHE_BUCKET
+        if not shared:
+            return self.build_static_cache(batch_size, max_cache_len)
+        if (
+            self._static_cache is None
+            or self._static_cache_shape[0] != batch_size
+            or self._static_cache_shape[1] < max_cache_len
+        ):
+            # Drop the old cache first so its memory can be reused by the new one
+            self._static_cache = None
+            self._static_cache = self.build_static_cache(batch_size, max_cache_len)
+            self._static_cache_shape = (batch_size, max_cache_len)
+        else:
+            self._static_cache.reset()
+        return self._static_cache
+
+    def get_prefix_cache(self, input_ids, inputs_embeds, return_copy=True):
+        """
+        Returns a copy of the KV cache for the text prefix preceding the first image token (system prompt and
+        the start of the user turn), computing and storing it on a miss. Everything after the first image token
+        depends on the images, so only this prefix can be shared between calls. Passing this cache together with the
+        full `inputs_embeds` relies on `generate` slicing the embeddings to the uncached positions (transformers >= 4.49).
+        """
+        if input_ids is None or input_ids.shape[0] != 1:
+            return None
+        image_token_indices = torch.where(input_ids[0] == IMAGE_TOKEN_INDEX)[0]
+        if len(image_token_indices) == 0:
+            return None
+        prefix_len = image_token_indices[0].item()
+        if prefix_len == 0:
+            return None
+
+        key = input_ids[0, :prefix_len].cpu().numpy().tobytes()
+        past_key_values = self._prefix_cache.get(key)
+        if past_key_values is None:
+            past_key_values = self.llm.model(
+                inputs_embeds=inputs_embeds[:, :prefix_len],
+                use_cache=True,
+            ).past_key_values
+            self._prefix_cache[key] = past_key_values
+            if len(self._prefix_cache) > PREFIX_CACHE_SIZE:
+                self._prefix_cache.popitem(last=False)
+        else:
+            self._prefix_cache.move_to_end(key)
+        # `generate` appends to the cache in place, so hand out a copy unless the caller only reads from it
+        return copy.deepcopy(past_key_values) if return_copy else past_key_values
+
     @torch.no_grad()
     def generate(
         self,
@@ -164,6 +299,10 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
         attention_mask: Optional[torch.LongTensor] = None,
         **generation_kwargs,
     ):
+        use_prefix_cache = generation_kwargs.pop("use_prefix_cache", True)
+        # The static KV cache only pays off with compiled decode steps; eager decoding would attend over the whole
+        # preallocated length, so it keeps the dynamic cache unless asked otherwise
+        use_static_cache = generation_kwargs.pop("use_static_cache", self._llm_compiled)
         if images is not None:
             (
                 _,
@@ -177,13 +316,56 @@ class LlavaLlamaModel(LlavaMetaModel, LlavaMetaForCausalLM, PreTrainedModel):
             )
         else:
             inputs_embeds = self.get_input_embeddings()(input_ids)
-        inputs_embeds = inputs_embeds.to(self.dtype)
+        # The projector is cast to the model dtype at load time, so this is normally already satisfied
+        if inputs_embeds.dtype != self.dtype:
+            inputs_embeds = inputs_embeds.to(self.dtype)
 
-        outputs = self.llm.generate(
-            inputs_embeds=inputs_embeds,
-            attention_mask=attention_mask,
-            **generation_kwargs
-        )
+        if self._llm_compiled:
+            inputs_embeds, attention_mask = self.pad_to_bucket(inputs_embeds, attention_mask)
+
+        holds_static_cache = False
+        try:
+            if (
+                generation_kwargs.get("use_cache", True)
+                and generation_kwargs.get("num_beams", 1) == 1
+                and "past_key_values" not in generation_kwargs
+            ):
+                # Left padding of a compiled LLM shifts the positions, so the prefix cache does not apply there
+                prefix_cache = None
+                if use_prefix_cache and not self._llm_compiled:
+                    prefix_cache = self.get_prefix_cache(input_ids, inputs_embeds, return_copy=not use_static_cache)
+
+                if use_static_cache:
+                    if not self._llm_compiled:
+                        # `generate` auto-compiles decode steps for a static cache on CUDA; keep them eager here
+                        generation_kwargs.setdefault("disable_compile", True)
+                    max_new_tokens = generation_kwargs.get("max_new_tokens") or self.get_llm().generation_config.max_new_tokens or 64
+                    # A `generate` running concurrently with another (e.g. streaming runs it on a thread) gets its own
+                    # cache instead of overwriting the KV in the shared one
+                    holds_static_cache = self._static_cache_lock.acquire(blocking=False)
+                    past_key_values = self.get_static_cache(
+                        inputs_embeds.shape[0], inputs_embeds.shape[1] + max_new_tokens, shared=holds_static_cache
+                    )
+                    if prefix_cache is not None:
+                        # Copy the shared prefix into the static cache instead of handing out a copy of the prefix cache
+                        if hasattr(prefix_cache, "to_legacy_cache"):
+                            prefix_cache = prefix_cache.to_legacy_cache()
+                        for layer_idx, (key_states, value_states) in enumerate(prefix_cache):
+                            cache_position = torch.arange(key_states.shape[2], device=key_states.device)
+                            past_key_values.update(key_states, value_states, layer_idx, {"cache_position": cache_position})
+                else:
+                    past_key_values = prefix_cache
+                if past_key_values is not None:
+                    generation_kwargs["past_key_values"] = past_key_values
+
+            outputs = self.llm.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                **generation_kwargs
+            )
+        finally:
+            if holds_static_cache:
+                self._static_cache_lock.release()
         return outputs
 
     def init_dam(self, conv_mode, prompt_mode):
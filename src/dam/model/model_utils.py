@@ -22,6 +22,7 @@ from transformers import (
 )
 
 from .language_model.llava_llama import LlavaLlamaModel
+from .language_model.builder import get_default_attn_implementation, get_default_torch_dtype
 # TODO: we may move LlavaConfig to configuration_llava.py
 # from model.configuration_llava import LlavaConfig
 
@@ -46,6 +47,8 @@ def load_pretrained_model(
     **kwargs,
 ):
     kwargs = {"device_map": device_map, **kwargs}
+    kwargs.setdefault("attn_implementation", get_default_attn_implementation())
+    kwargs.setdefault("torch_dtype", get_default_torch_dtype())
 
     if device != "cuda":
         kwargs["device_map"] = {"": device}
@@ -53,15 +56,14 @@ def load_pretrained_model(
     if load_8bit:
         kwargs["load_in_8bit"] = True
     elif load_4bit:
-        kwargs["load_in_4bit"] = True
+        # Weight-only NF4 for the LLM. Only `build_llm_and_tokenizer` receives `quantization_config`, so the
+        # vision tower, projector and context provider stay in `torch_dtype`.
         kwargs["quantization_config"] = BitsAndBytesConfig(
             load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_compute_dtype=kwargs["torch_dtype"],
             bnb_4bit_use_double_quant=True,
             bnb_4bit_quant_type="nf4",
         )
-    else:
-        kwargs["torch_dtype"] = torch.float16
 
     config = AutoConfig.from_pretrained(model_path)
     config.resume_path = model_path
@@ -89,13 +91,14 @@ def load_pretrained_model(
     #     )
 
     model.resize_token_embeddings(len(tokenizer))
+    torch_dtype = eval(config.model_dtype)
     vision_tower = model.get_vision_tower()
-    vision_tower.to(device=device, dtype=torch.float16)
+    vision_tower.to(device=device, dtype=torch_dtype)
     mm_projector = model.get_mm_projector()
-    mm_projector.to(device=device, dtype=torch.float16)
+    mm_projector.to(device=device, dtype=torch_dtype)
     context_provider = model.get_context_provider()
     if context_provider is not None:
-        context_provider.to(device=device, dtype=torch.float16)
+        context_provider.to(device=device, dtype=torch_dtype)
     image_processor = vision_tower.image_processor
 
     if hasattr(model.llm.config, "max_sequence_length"):
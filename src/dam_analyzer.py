@@ -4,20 +4,64 @@ DAM Analyzer Module
 DAM 비디오 분석 기능을 담당 (TensorRT 최적화 지원)
 """
 
+import importlib.util
+import logging
 import subprocess
 import sys
-import re
+import threading
+from collections import deque
 from pathlib import Path
 from typing import List, Optional
 
+from cuda_env import set_cuda_alloc_conf
+
+logger = logging.getLogger(__name__)
+
+# 설명 추출 시 무시할 DAM/SAM2 진행률·경고 출력
+OUTPUT_NOISE = ("frame loading", "propagate in video", "Loading checkpoint", "UserWarning")
+
+# subprocess 모드에서 보관할 stdout / stderr 마지막 라인 수
+SUBPROCESS_TAIL_LINES = 200
+
+# DAM 스크립트 경로별 모듈 / 상주 모델 / 모델 락 (프로세스당 1회 로드, DAMAnalyzer 인스턴스 간 공유)
+_dam_modules = {}
+_dam_models = {}
+_dam_model_locks = {}
+_dam_registry_lock = threading.Lock()
+
+
+def _dam_script_key(dam_script_path: Path) -> str:
+    """공유 캐시 키로 쓸 DAM 스크립트 절대 경로"""
+    return str(Path(dam_script_path).resolve())
+
+
+def _load_dam_module(dam_script_path: Path):
+    """DAM 스크립트를 모듈로 import (스크립트 경로별로 프로세스당 1회 실행)"""
+    key = _dam_script_key(dam_script_path)
+    with _dam_registry_lock:
+        module = _dam_modules.get(key)
+        if module is None:
+            # DAM 스크립트는 같은 디렉토리의 dam / sam2 패키지를 import
+            script_dir = str(Path(key).parent)
+            if script_dir not in sys.path:
+                sys.path.insert(0, script_dir)
+            
+            spec = importlib.util.spec_from_file_location("dam_cli", key)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _dam_modules[key] = module
+        return module
+
 class DAMAnalyzer:
     """DAM 분석 클래스 (TensorRT 최적화 지원)"""
     
     def __init__(self, dam_script_path: Path, temperature: float = 0.1, top_p: float = 0.15, 
-                 use_tensorrt: bool = True, tensorrt_cache_dir: str = "tensorrt_cache"):
+                 use_tensorrt: bool = True, tensorrt_cache_dir: str = "tensorrt_cache",
+                 load_4bit: bool = False, preload_model: bool = True):
         self.dam_script_path = dam_script_path
         self.temperature = temperature
         self.top_p = top_p
+        self.load_4bit = load_4bit  # LLM 4bit(NF4) 가중치 양자화
         self.use_tensorrt = use_tensorrt
         self.tensorrt_cache_dir = tensorrt_cache_dir
         
@@ -28,6 +72,20 @@ class DAMAnalyzer:
         if not self.dam_script_path.exists():
             raise FileNotFoundError(f"DAM script not found at: {self.dam_script_path}")
         
+        # DAM 스크립트 모듈과 모델은 처음 필요할 때 로드 (torch / transformers import 지연)
+        # 로드 후에는 프로세스 내에 상주시켜 같은 스크립트를 쓰는 인스턴스끼리 재사용
+        self._dam_key = _dam_script_key(self.dam_script_path)
+        self._dam = None
+        self._model = None
+        with _dam_registry_lock:
+            self._model_lock = _dam_model_locks.setdefault(self._dam_key, threading.Lock())
+        
+        # 프로세스 내 모델 로드에 실패하면 False로 전환되어 DAM 스크립트를 subprocess로 실행
+        self._in_process = True
+        
+        # 토큰화된 프롬프트 (모델 로드 후 1회 계산, set_prompt 시 무효화)
+        self._prompt_ids = None
+        
         # 기본 프롬프트
         self.prompt = (
             "Video: <image><image><image><image><image><image><image><image>\n"
@@ -38,41 +96,146 @@ class DAMAnalyzer:
         # TensorRT 초기화 시도
         if self.use_tensorrt:
             self._initialize_tensorrt()
+        
+        # TensorRT를 쓰지 않으면 DAM 모델을 미리 로드하고 프롬프트를 토큰화 (TensorRT 사용 시에는 fallback 때 로드)
+        if preload_model and self.tensorrt_optimizer is None:
+            with self._model_lock:
+                if self._ensure_model():
+                    self._get_prompt_ids()
+    
+    def _get_dam_module(self):
+        """DAM 스크립트 모듈 반환 (프로세스 내 최초 호출 시 1회 import)"""
+        if self._dam is None:
+            self._dam = _load_dam_module(self.dam_script_path)
+        return self._dam
+    
+    def _get_dam_model(self):
+        """상주 DAM 모델 반환 (프로세스 내 최초 호출 시 1회 로드, lock 보유 상태에서 호출)"""
+        if self._model is None:
+            model_key = (self._dam_key, self.load_4bit)
+            model = _dam_models.get(model_key)
+            if model is None:
+                logger.info("🚀 DAM 모델 로드 중...")
+                model = self._get_dam_module().load_model(load_4bit=self.load_4bit)
+                _dam_models[model_key] = model
+                logger.info("✅ DAM 모델 로드 완료")
+            self._model = model
+        return self._model
+    
+    def _get_prompt_ids(self):
+        """토큰화된 프롬프트 반환 (필요 시 모델 로드 후 1회 토큰화)"""
+        if self._prompt_ids is None:
+            self._prompt_ids = self._get_dam_module().tokenize_query(self._get_dam_model(), self.prompt)
+        return self._prompt_ids
+    
+    def _ensure_model(self) -> bool:
+        """상주 DAM 모델 준비, import / 로드 실패 시 subprocess 모드로 전환 (lock 보유 상태에서 호출)"""
+        if self._in_process:
+            try:
+                self._get_dam_model()
+            except Exception as e:
+                logger.warning("⚠️ DAM 모델 로드 실패, subprocess 모드로 전환: %s", e)
+                # subprocess가 가중치를 따로 올리므로 상주 모델 참조는 해제
+                self._model = None
+                self._prompt_ids = None
+                self._in_process = False
+        return self._in_process
+    
+    def _run_dam_subprocess(self, video_path: Path, bbox_normalized: List[float], use_sam2: bool) -> str:
+        """DAM 스크립트를 별도 프로세스로 실행하고 출력 반환"""
+        cmd = [
+            sys.executable, str(self.dam_script_path),
+            "--video_file", str(video_path),
+            "--box", str(list(bbox_normalized)),
+            "--normalized_coords",
+            "--use_box",
+            "--no_stream",
+            "--temperature", str(self.temperature),
+            "--top_p", str(self.top_p),
+            "--query", self.prompt,
+        ]
+        if use_sam2:
+            cmd.append("--use_sam2")
+        if self.load_4bit:
+            cmd.append("--load_4bit")
+        
+        # close_fds=False이면 CPython이 fork+exec 대신 posix_spawn으로 실행
+        proc = subprocess.Popen(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                bufsize=1, close_fds=False)
+        
+        # stderr(SAM2 진행률 등)는 별도 스레드에서 비우며 마지막 라인만 보관
+        stderr_tail = deque(maxlen=SUBPROCESS_TAIL_LINES)
+        stderr_thread = threading.Thread(target=stderr_tail.extend, args=(proc.stderr,), daemon=True)
+        stderr_thread.start()
+        
+        # stdout은 라인 단위로 읽어 마지막 라인만 보관 (설명은 출력 마지막에 위치)
+        # 설명이 나와도 프로세스는 끝까지 실행 (스크립트의 임시 프레임 디렉토리 정리를 위해)
+        stdout_tail = deque(proc.stdout, maxlen=SUBPROCESS_TAIL_LINES)
+        returncode = proc.wait()
+        stderr_thread.join()
+        
+        if returncode != 0:
+            logger.error("[DAM stderr] ↓↓↓\n%s", "".join(stderr_tail))
+            raise RuntimeError(f"DAM exited {returncode}")
+        return "".join(stdout_tail or stderr_tail)
+    
+    def _describe(self, video_path: Path, bbox_normalized: List[float], use_sam2: bool) -> str:
+        """상주 DAM 모델로 설명 생성 (모델을 쓸 수 없으면 subprocess로 실행)"""
+        with self._model_lock:
+            in_process = self._ensure_model()
+            if in_process:
+                raw_output = self._get_dam_module().describe(
+                    self._get_dam_model(),
+                    str(video_path),
+                    bbox_normalized,
+                    use_sam2=use_sam2,
+                    normalized_coords=True,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    query=self.prompt,
+                    input_ids=self._get_prompt_ids(),
+                )
+        if not in_process:
+            raw_output = self._run_dam_subprocess(video_path, bbox_normalized, use_sam2)
+        return self._extract_description(raw_output)
     
     def _initialize_tensorrt(self):
         """TensorRT 최적화기 초기화"""
         try:
+            # TensorRT가 CUDA를 초기화하기 전에 DAM 스크립트와 같은 할당자 설정 적용
+            set_cuda_alloc_conf()
             from dam_tensorrt_optimizer import create_optimized_dam_analyzer
             
-            print("🚀 TensorRT 최적화 초기화 중...")
+            logger.info("🚀 TensorRT 최적화 초기화 중...")
             self.tensorrt_optimizer = create_optimized_dam_analyzer(
                 model_path="nvidia/DAM-3B-Video",
                 cache_dir=self.tensorrt_cache_dir,
                 force_rebuild=False  # 기존 엔진이 있으면 재사용
             )
-            print("✅ TensorRT 최적화 완료 - 고속 추론 모드 활성화")
+            logger.info("✅ TensorRT 최적화 완료 - 고속 추론 모드 활성화")
             
         except Exception as e:
-            print(f"⚠️ TensorRT 초기화 실패, 기본 모드로 전환: {e}")
+            logger.warning("⚠️ TensorRT 초기화 실패, 기본 모드로 전환: %s", e)
             self.use_tensorrt = False
             self.tensorrt_optimizer = None
     
     def _extract_description(self, raw_output: str) -> str:
         """DAM 출력에서 설명 추출"""
-        desc = ""
-        for line in raw_output.splitlines():
-            if line.startswith("Description:"):
-                desc = line.split("Description:", 1)[1].strip()
+        lines = raw_output.splitlines()
         
-        if desc:
-            return desc
+        # 마지막 "Description:" 라인 사용 (뒤에서부터 탐색)
+        for line in reversed(lines):
+            if line.startswith("Description:"):
+                desc = line[len("Description:"):].strip()
+                if desc:
+                    return desc
+                break
         
         # fallback - 진행률 표시줄이나 경고가 아닌 마지막 깨끗한 줄 선택
-        clean_lines = [
-            l for l in raw_output.splitlines() 
-            if l.strip() and not re.search(r"frame loading|propagate in video|Loading checkpoint|UserWarning", l)
-        ]
-        return clean_lines[-1].strip() if clean_lines else raw_output.strip()
+        for line in reversed(lines):
+            if line.strip() and not any(noise in line for noise in OUTPUT_NOISE):
+                return line.strip()
+        return raw_output.strip()
     
     def _analyze_with_tensorrt(self, video_path: Path, bbox_normalized: List[float], use_sam2: bool = False) -> Optional[str]:
         """TensorRT를 사용한 고속 분석"""
@@ -102,7 +265,7 @@ class DAMAnalyzer:
             cap.release()
             
             if len(frames) != 8:
-                print(f"⚠️ 프레임 추출 실패: {len(frames)}/8")
+                logger.warning("⚠️ 프레임 추출 실패: %d/8", len(frames))
                 return None
             
             # 마스크 생성
@@ -122,18 +285,18 @@ class DAMAnalyzer:
                 masks.append(Image.fromarray(mask_array))
             
             # TensorRT 추론
-            print("🔥 TensorRT 고속 추론 실행...")
+            logger.debug("🔥 TensorRT 고속 추론 실행...")
             description = self.tensorrt_optimizer.infer(frames, masks)
             
             if description:
-                print(f"✅ TensorRT 분석 완료: {description}")
+                logger.info("✅ TensorRT 분석 완료: %s", description)
                 return description
             else:
-                print("⚠️ TensorRT 추론 실패, 기본 모드로 전환")
+                logger.warning("⚠️ TensorRT 추론 실패, 기본 모드로 전환")
                 return None
                 
         except Exception as e:
-            print(f"❌ TensorRT 분석 실패: {e}")
+            logger.error("❌ TensorRT 분석 실패: %s", e)
             return None
     
     def analyze_with_bbox(self, video_path: Path, bbox_normalized: List[float]) -> Optional[str]:
@@ -143,37 +306,17 @@ class DAMAnalyzer:
             result = self._analyze_with_tensorrt(video_path, bbox_normalized, use_sam2=False)
             if result:
                 return result
-            print("🔄 기본 모드로 전환...")
+            logger.info("🔄 기본 모드로 전환...")
         
-        # 기본 subprocess 방식
+        # 기본 방식 (프로세스 내 DAM 모델)
         try:
-            cmd = [
-                sys.executable, str(self.dam_script_path),
-                "--video_file", str(video_path),
-                "--box", str(bbox_normalized),
-                "--normalized_coords",
-                "--use_box",
-                "--no_stream",
-                "--temperature", str(self.temperature),
-                "--top_p", str(self.top_p),
-                "--query", self.prompt,
-            ]
-            # --use_sam2 플래그 없음 = bbox 기반 마스크 사용
-            
-            print("🔍 DAM 분석 시작 (bbox 기반 마스크)...")
-            result = subprocess.run(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if result.returncode != 0:
-                print("[DAM stderr] ↓↓↓")
-                print(result.stderr)
-                raise RuntimeError(f"DAM exited {result.returncode}")
-            
-            description = self._extract_description(result.stdout or result.stderr)
-            print(f"✅ DAM 분석 완료: {description}")
+            logger.debug("🔍 DAM 분석 시작 (bbox 기반 마스크)...")
+            description = self._describe(video_path, bbox_normalized, use_sam2=False)
+            logger.info("✅ DAM 분석 완료: %s", description)
             return description
             
         except Exception as e:
-            print(f"❌ DAM 분석 실패: {e}")
+            logger.error("❌ DAM 분석 실패: %s", e)
             return None
     
     def analyze_with_sam2(self, video_path: Path, bbox_normalized: List[float]) -> Optional[str]:
@@ -183,37 +326,17 @@ class DAMAnalyzer:
             result = self._analyze_with_tensorrt(video_path, bbox_normalized, use_sam2=True)
             if result:
                 return result
-            print("🔄 기본 모드로 전환...")
+            logger.info("🔄 기본 모드로 전환...")
         
-        # 기본 subprocess 방식
+        # 기본 방식 (프로세스 내 DAM 모델)
         try:
-            cmd = [
-                sys.executable, str(self.dam_script_path),
-                "--video_file", str(video_path),
-                "--box", str(bbox_normalized),
-                "--normalized_coords",
-                "--use_box",
-                "--use_sam2",  # SAM2 처리 명시적 요청
-                "--no_stream",
-                "--temperature", str(self.temperature),
-                "--top_p", str(self.top_p),
-                "--query", self.prompt,
-            ]
-            
-            print("🔍 DAM 분석 시작 (SAM2 세그멘테이션)...")
-            result = subprocess.run(cmd, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if result.returncode != 0:
-                print("[DAM stderr] ↓↓↓")
-                print(result.stderr)
-                raise RuntimeError(f"DAM exited {result.returncode}")
-            
-            description = self._extract_description(result.stdout or result.stderr)
-            print(f"✅ DAM 분석 완료 (SAM2): {description}")
+            logger.debug("🔍 DAM 분석 시작 (SAM2 세그멘테이션)...")
+            description = self._describe(video_path, bbox_normalized, use_sam2=True)
+            logger.info("✅ DAM 분석 완료 (SAM2): %s", description)
             return description
             
         except Exception as e:
-            print(f"❌ DAM 분석 실패 (SAM2): {e}")
+            logger.error("❌ DAM 분석 실패 (SAM2): %s", e)
             return None
     
     def analyze_video(self, video_path: Path, bbox_normalized: List[float], use_sam2: bool = False) -> Optional[str]:
@@ -223,10 +346,45 @@ class DAMAnalyzer:
         else:
             return self.analyze_with_bbox(video_path, bbox_normalized)
     
+    def analyze_video_batch(self, video_path: Path, bboxes: List[List[float]], use_sam2: bool = False) -> Optional[List[str]]:
+        """같은 비디오의 여러 bbox를 한 번의 DAM 배치 추론으로 분석 (bbox 순서대로 설명 반환)"""
+        if not bboxes:
+            return []
+        
+        try:
+            logger.debug("🔍 DAM 배치 분석 시작 (%d개 bbox)...", len(bboxes))
+            with self._model_lock:
+                in_process = self._ensure_model()
+                if in_process:
+                    raw_outputs = self._get_dam_module().describe_batch(
+                        self._get_dam_model(),
+                        str(video_path),
+                        bboxes,
+                        use_sam2=use_sam2,
+                        normalized_coords=True,
+                        temperature=self.temperature,
+                        top_p=self.top_p,
+                        query=self.prompt,
+                        input_ids=self._get_prompt_ids(),
+                    )
+            if not in_process:
+                # subprocess 모드에서는 bbox마다 개별 실행
+                raw_outputs = [self._run_dam_subprocess(video_path, bbox, use_sam2) for bbox in bboxes]
+            descriptions = [self._extract_description(raw_output) for raw_output in raw_outputs]
+            logger.info("✅ DAM 배치 분석 완료: %d개", len(descriptions))
+            return descriptions
+            
+        except Exception as e:
+            logger.error("❌ DAM 배치 분석 실패: %s", e)
+            return None
+    
     def set_prompt(self, new_prompt: str):
         """프롬프트 변경"""
-        self.prompt = new_prompt
-        print(f"📝 프롬프트 변경됨: {new_prompt[:50]}...")
+        # 분석 중인 스레드가 이전 프롬프트의 토큰을 다시 캐시하지 않도록 모델 락 안에서 교체
+        with self._model_lock:
+            self.prompt = new_prompt
+            self._prompt_ids = None
+        logger.info("📝 프롬프트 변경됨: %.50s...", new_prompt)
     
     def set_parameters(self, temperature: float = None, top_p: float = None):
         """분석 파라미터 변경"""
@@ -234,7 +392,7 @@ class DAMAnalyzer:
             self.temperature = temperature
         if top_p is not None:
             self.top_p = top_p
-        print(f"⚙️ 파라미터 변경: temperature={self.temperature}, top_p={self.top_p}")
+        logger.info("⚙️ 파라미터 변경: temperature=%s, top_p=%s", self.temperature, self.top_p)
     
     def enable_tensorrt(self, force_rebuild: bool = False):
         """TensorRT 최적화 활성화"""
@@ -249,15 +407,15 @@ class DAMAnalyzer:
                     cache_dir=self.tensorrt_cache_dir,
                     force_rebuild=True
                 )
-                print("🔄 TensorRT 엔진 재빌드 완료")
+                logger.info("🔄 TensorRT 엔진 재빌드 완료")
             except Exception as e:
-                print(f"❌ TensorRT 재빌드 실패: {e}")
+                logger.error("❌ TensorRT 재빌드 실패: %s", e)
     
     def disable_tensorrt(self):
         """TensorRT 최적화 비활성화"""
         self.use_tensorrt = False
         self.tensorrt_optimizer = None
-        print("⚠️ TensorRT 최적화 비활성화 - 기본 모드 사용")
+        logger.warning("⚠️ TensorRT 최적화 비활성화 - 기본 모드 사용")
     
     def get_info(self) -> dict:
         """분석기 정보 반환"""
@@ -265,9 +423,11 @@ class DAMAnalyzer:
             "dam_script_path": str(self.dam_script_path),
             "temperature": self.temperature,
             "top_p": self.top_p,
+            "load_4bit": self.load_4bit,
             "prompt": self.prompt,
             "use_tensorrt": self.use_tensorrt,
-            "tensorrt_available": self.tensorrt_optimizer is not None
+            "tensorrt_available": self.tensorrt_optimizer is not None,
+            "dam_model_loaded": self._model is not None
         }
         
         # TensorRT 성능 정보 추가
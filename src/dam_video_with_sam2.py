@@ -17,17 +17,38 @@
 # This script is used to segment objects in a video using SAM2 and then describe the segmented objects using DAM. 
 # This script uses SAM (v2.1) and requires localization for the first frame.
 
+# Must be set before CUDA is initialized; an explicit PYTORCH_CUDA_ALLOC_CONF from the environment wins.
+from cuda_env import set_cuda_alloc_conf
+set_cuda_alloc_conf()
+
 import argparse
 import ast
+import atexit
+import logging
+import os
+import shutil
 import torch
 import numpy as np
 from PIL import Image
 from dam import DescribeAnythingModel, disable_torch_init
 import cv2
 import glob
-import os
 import tempfile
-from sam2.build_sam import build_sam2_video_predictor
+from collections import OrderedDict
+
+DEFAULT_QUERY = 'Video: <image><image><image><image><image><image><image><image>\nGiven the video in the form of a sequence of frames above, describe the object in the masked region in the video in detail.'
+DEFAULT_MODEL_PATH = 'nvidia/DAM-3B-Video'
+SAM2_CHECKPOINT = "checkpoints/sam2.1_hiera_large.pt"
+SAM2_MODEL_CFG = "configs/sam2.1/sam2.1_hiera_l.yaml"
+NUM_FRAMES = 8
+# Number of recent clips whose extracted frames are kept for reuse
+FRAME_CACHE_SIZE = 4
+
+logger = logging.getLogger(__name__)
+
+PROMPT_MODES = {
+    "focal_prompt": "full+focal_crop",
+}
 
 def extract_frames_from_video(video_path):
     """Extract frames from a video file and save them to a temporary directory."""
@@ -52,17 +73,55 @@ def extract_frames_from_video(video_path):
     
     return frame_paths, temp_dir
 
-def apply_sam2(image_files, points=None, box=None, normalized_coords=False, use_sam2=False):
+_frame_cache = OrderedDict()
+
+def load_clip(video_file):
+    """Extract the frames of `video_file` once and keep them for later requests on the same clip.
+
+    Clips are keyed by path and mtime, so bbox and SAM2 requests on the same recording share the
+    frame extraction and decoding. Returns a dict with all frame paths, the indices of the NUM_FRAMES
+    selected frames and those frames as PIL images.
+    """
+    key = (os.path.abspath(video_file), os.path.getmtime(video_file), NUM_FRAMES)
+    clip = _frame_cache.get(key)
+    if clip is not None:
+        _frame_cache.move_to_end(key)
+        return clip
+
+    image_files, temp_dir = extract_frames_from_video(video_file)
+    indices = np.linspace(0, len(image_files)-1, NUM_FRAMES, dtype=int)
+    clip = {
+        "image_files": image_files,
+        "temp_dir": temp_dir,
+        "indices": indices,
+        "images": [Image.open(image_files[i]).convert('RGB') for i in indices],
+    }
+    _frame_cache[key] = clip
+    while len(_frame_cache) > FRAME_CACHE_SIZE:
+        _, evicted = _frame_cache.popitem(last=False)
+        shutil.rmtree(evicted["temp_dir"], ignore_errors=True)
+    return clip
+
+@atexit.register
+def clear_frame_cache():
+    """Remove the extracted frames of all cached clips."""
+    while _frame_cache:
+        _, clip = _frame_cache.popitem()
+        shutil.rmtree(clip["temp_dir"], ignore_errors=True)
+
+def apply_sam2(image_files, points=None, box=None, normalized_coords=False, use_sam2=False, predictor=None):
     """Apply SAM2 to video frames using points or box on first frame
     
     Args:
         use_sam2: If True, use SAM2 processing. If False (default), create rectangular masks from bbox
+        predictor: SAM2 video predictor, required when use_sam2 is True
     """
     
     if not use_sam2 and box is not None:
         # Default behavior: Skip SAM2 processing - create simple rectangular masks from bbox
-        first_frame = cv2.imread(image_files[0])
-        height, width = first_frame.shape[:2]
+        # (only the image header is read to get the frame size)
+        with Image.open(image_files[0]) as first_frame:
+            width, height = first_frame.size
         
         if normalized_coords:
             x1, y1, x2, y2 = box
@@ -73,20 +132,20 @@ def apply_sam2(image_files, points=None, box=None, normalized_coords=False, use_
         else:
             x1, y1, x2, y2 = map(int, box)
         
-        # Create rectangular mask for all frames
-        masks = []
-        for img_file in image_files:
-            mask = np.zeros((height, width), dtype=bool)
-            mask[y1:y2, x1:x2] = True
-            masks.append(mask)
+        # Rasterize the rectangle once and share it across all frames (masks are read-only downstream)
+        mask = np.zeros((height, width), dtype=bool)
+        mask[y1:y2, x1:x2] = True
+        masks = [mask] * len(image_files)
         
-        print(f"Using bbox-based masks (default mode): [{x1},{y1},{x2},{y2}]")
+        logger.debug("Using bbox-based masks (default mode): [%d,%d,%d,%d]", x1, y1, x2, y2)
         return masks
     elif not use_sam2:
         raise ValueError("Default mode requires box coordinates")
 
     # SAM2 processing (only when explicitly requested)
-    print("Using SAM2 segmentation processing...")
+    if predictor is None:
+        raise ValueError("SAM2 processing requires a loaded predictor")
+    logger.debug("Using SAM2 segmentation processing...")
     
     # If coordinates are normalized, convert them to absolute coordinates
     if normalized_coords:
@@ -142,6 +201,123 @@ def apply_sam2(image_files, points=None, box=None, normalized_coords=False, use_
 
     return masks
 
+def load_sam2_predictor(device):
+    """Build the SAM2 video predictor used for `use_sam2` mask propagation."""
+    # Imported here: the sam2 package initializes hydra on import and is only needed for SAM2 masks
+    from sam2.build_sam import build_sam2_video_predictor
+
+    predictor = build_sam2_video_predictor(SAM2_MODEL_CFG, SAM2_CHECKPOINT, device=device)
+    logger.info("SAM2 model loaded")
+    return predictor
+
+def load_model(model_path=DEFAULT_MODEL_PATH, conv_mode='v1', prompt_mode='focal_prompt', use_sam2=False, device=None, compile_llm=False, **kwargs):
+    """Load DAM (and optionally SAM2) once so that repeated `describe` calls reuse the resident weights.
+
+    Returns a dict holding the DAM model, the SAM2 predictor (None until SAM2 is first needed) and the device.
+    """
+    if torch.cuda.is_available() and torch.cuda.get_device_properties(0).major >= 8:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    disable_torch_init()
+
+    if compile_llm:
+        # The compiled LLM decodes into a static KV cache, which FlashAttention-2 does not support
+        kwargs.setdefault("attn_implementation", "sdpa")
+
+    dam = DescribeAnythingModel(
+        model_path=model_path,
+        conv_mode=conv_mode,
+        prompt_mode=PROMPT_MODES.get(prompt_mode, prompt_mode),
+        **kwargs,
+    ).to(device)
+    if compile_llm:
+        dam.model.compile_llm()
+
+    predictor = load_sam2_predictor(device) if use_sam2 else None
+
+    return {"dam": dam, "predictor": predictor, "device": device}
+
+def prepare_inputs(image_files, points=None, box=None, normalized_coords=False, use_sam2=False, predictor=None):
+    """Select NUM_FRAMES frames uniformly and build the matching (image, mask) PIL pairs for DAM."""
+    indices = np.linspace(0, len(image_files)-1, NUM_FRAMES, dtype=int)
+    selected_files = [image_files[i] for i in indices]
+
+    # Process video (default: bbox-based masks, optional: SAM2)
+    masks = apply_sam2(image_files, points=points, box=box,
+                      normalized_coords=normalized_coords,
+                      use_sam2=use_sam2, predictor=predictor)
+
+    # Select masks for the frames we want
+    selected_masks = [masks[i] for i in indices]
+
+    # Convert frames to PIL images
+    processed_images = [Image.open(f).convert('RGB') for f in selected_files]
+    processed_masks = masks_to_pil(selected_masks)
+
+    return selected_files, selected_masks, processed_images, processed_masks
+
+def masks_to_pil(masks):
+    """Convert boolean masks to the 0/255 PIL masks DAM expects (a mask shared by several frames is converted once)."""
+    converted = {}
+    mask_pils = []
+    for m in masks:
+        if id(m) not in converted:
+            converted[id(m)] = Image.fromarray((m.squeeze() * 255).astype(np.uint8))
+        mask_pils.append(converted[id(m)])
+    return mask_pils
+
+def tokenize_query(model, query=DEFAULT_QUERY):
+    """Tokenize `query` once for reuse as `input_ids` in `describe` / `describe_batch`."""
+    return model["dam"].get_prompt_input_ids(query)
+
+def describe(model, video_file, box=None, points=None, use_sam2=False, normalized_coords=True,
+             query=DEFAULT_QUERY, temperature=0.2, top_p=0.5, max_new_tokens=512, input_ids=None):
+    """Describe the region given by `box` (or `points`) in `video_file` with an already loaded model.
+
+    `model` is the dict returned by `load_model`. The SAM2 predictor is loaded lazily on the first
+    `use_sam2` request and kept in `model` afterwards. `input_ids` is an optional `query` pre-tokenized
+    with `tokenize_query`.
+    """
+    if use_sam2 and model["predictor"] is None:
+        model["predictor"] = load_sam2_predictor(model["device"])
+
+    clip = load_clip(video_file)
+    masks = apply_sam2(clip["image_files"], points=points, box=box,
+                      normalized_coords=normalized_coords,
+                      use_sam2=use_sam2, predictor=model["predictor"])
+    processed_masks = masks_to_pil([masks[i] for i in clip["indices"]])
+
+    return model["dam"].get_description(
+        clip["images"], processed_masks, query,
+        temperature=temperature, top_p=top_p, num_beams=1, max_new_tokens=max_new_tokens, input_ids=input_ids,
+    )
+
+def describe_batch(model, video_file, boxes, use_sam2=False, normalized_coords=True,
+                   query=DEFAULT_QUERY, temperature=0.2, top_p=0.5, max_new_tokens=512, input_ids=None):
+    """Describe several boxes in the same video with one batched DAM `generate` call.
+
+    Frames are loaded once for all boxes. Returns one description per box, in order.
+    """
+    if use_sam2 and model["predictor"] is None:
+        model["predictor"] = load_sam2_predictor(model["device"])
+
+    clip = load_clip(video_file)
+    processed_masks_per_box = []
+    for box in boxes:
+        masks = apply_sam2(clip["image_files"], box=box,
+                          normalized_coords=normalized_coords,
+                          use_sam2=use_sam2, predictor=model["predictor"])
+        processed_masks_per_box.append(masks_to_pil([masks[i] for i in clip["indices"]]))
+
+    return model["dam"].get_descriptions_batch(
+        clip["images"], processed_masks_per_box, query,
+        temperature=temperature, top_p=top_p, num_beams=1, max_new_tokens=max_new_tokens, input_ids=input_ids,
+    )
+
 def print_streaming(text):
     """Helper function to print streaming text with flush"""
     print(text, end="", flush=True)
@@ -193,8 +369,8 @@ if __name__ == '__main__':
                        help='Points for first frame, format: [[x1,y1], [x2,y2], ...]')
     parser.add_argument('--box', type=str, default=None,
                        help='Box for first frame, format: [x1,y1,x2,y2]')
-    parser.add_argument('--query', type=str, default='Video: <image><image><image><image><image><image><image><image>\nGiven the video in the form of a sequence of frames above, describe the object in the masked region in the video in detail.', help='Prompt for the model')
-    parser.add_argument('--model_path', type=str, default='nvidia/DAM-3B-Video', help='Path to the model checkpoint')
+    parser.add_argument('--query', type=str, default=DEFAULT_QUERY, help='Prompt for the model')
+    parser.add_argument('--model_path', type=str, default=DEFAULT_MODEL_PATH, help='Path to the model checkpoint')
     parser.add_argument('--prompt_mode', type=str, default='focal_prompt', help='Prompt mode')
     parser.add_argument('--conv_mode', type=str, default='v1', help='Conversation mode')
     parser.add_argument('--temperature', type=float, default=0.2, help='Sampling temperature')
@@ -208,64 +384,43 @@ if __name__ == '__main__':
                        help='Directory to save the output images with contours')
     parser.add_argument('--use_sam2', action='store_true', 
                        help='Use SAM2 segmentation processing (default: use bbox-based rectangular masks)')
+    parser.add_argument('--load_4bit', action='store_true',
+                       help='Load the LLM with 4-bit NF4 weight-only quantization (requires bitsandbytes)')
+    parser.add_argument('--compile_llm', action='store_true',
+                       help='Compile the LLM with CUDA graphs (torch.compile reduce-overhead) and use a static KV cache')
 
     args = parser.parse_args()
-    
-    if torch.cuda.is_available() and torch.cuda.get_device_properties(0).major >= 8:
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-    
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     
     # Only initialize SAM2 if explicitly requested
-    if args.use_sam2:
-        sam2_checkpoint = "checkpoints/sam2.1_hiera_large.pt"
-        model_cfg = "configs/sam2.1/sam2.1_hiera_l.yaml"
-        predictor = build_sam2_video_predictor(model_cfg, sam2_checkpoint, device=device)
-        print("SAM2 model loaded")
-    else:
-        predictor = None
+    if not args.use_sam2:
         print("Using bbox-based masks (default mode)")
+    model = load_model(
+        model_path=args.model_path,
+        conv_mode=args.conv_mode,
+        prompt_mode=args.prompt_mode,
+        use_sam2=args.use_sam2,
+        load_4bit=args.load_4bit,
+        compile_llm=args.compile_llm,
+    )
+    dam = model["dam"]
 
     # Get list of image files and sort them
     if args.video_file:
         image_files, temp_dir = extract_frames_from_video(args.video_file)
     else:
         image_files = sorted(glob.glob(os.path.join(args.video_dir, "*.jpg")))
-    
-    # Select 8 frames uniformly
-    indices = np.linspace(0, len(image_files)-1, 8, dtype=int)
-    
-    selected_files = [image_files[i] for i in indices]
 
     # Parse points or box for first frame
     points = ast.literal_eval(args.points) if args.points else None
     box = ast.literal_eval(args.box) if args.box else None
 
-    # Process video (default: bbox-based masks, optional: SAM2)
-    masks = apply_sam2(image_files, points=points, box=box, 
-                      normalized_coords=args.normalized_coords,
-                      use_sam2=args.use_sam2)
-    
-    # Select masks for the 8 frames we want
-    selected_masks = [masks[i] for i in indices]
-
-    # Convert frames to PIL images
-    processed_images = [Image.open(f).convert('RGB') for f in selected_files]
-    processed_masks = [Image.fromarray((m.squeeze() * 255).astype(np.uint8)) for m in selected_masks]
-
-    # Initialize DAM model and get description
-    disable_torch_init()
-
-    prompt_modes = {
-        "focal_prompt": "full+focal_crop",
-    }
-    
-    dam = DescribeAnythingModel(
-        model_path=args.model_path,
-        conv_mode=args.conv_mode,
-        prompt_mode=prompt_modes.get(args.prompt_mode, args.prompt_mode),
-    ).to(device)
+    selected_files, selected_masks, processed_images, processed_masks = prepare_inputs(
+        image_files, points=points, box=box,
+        normalized_coords=args.normalized_coords,
+        use_sam2=args.use_sam2, predictor=model["predictor"],
+    )
 
     # Get description
     print("Description:")
@@ -306,5 +461,4 @@ if __name__ == '__main__':
 
     # Clean up temporary directory if we extracted frames from video
     if args.video_file:
-        import shutil
         shutil.rmtree(temp_dir)
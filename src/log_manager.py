@@ -4,62 +4,243 @@ Log Manager Module
 로그 저장 및 관리 기능을 담당
 """
 
+import atexit
 import json
-from datetime import datetime, timedelta
+import logging
+import math
+import os
+import threading
+import weakref
+from datetime import datetime
 from pathlib import Path
 from typing import Dict, Optional, List
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 로그 라인 포맷 (.jsonl 파일은 {"t": 시간 범위, "d": 설명, "b": bbox 정보} 한 줄씩)
+JSONL_SUFFIX = ".jsonl"
+LOG_LINE_FORMAT = "{}\t{}\t{}\n"
+LOG_LINE_FORMAT_NO_BBOX = "{}\t{}\n"
+
+# 시간 범위 포맷: 시작은 날짜 포함, 종료는 시각만
+START_TIME_FORMAT = "%Y-%m-%d-%H%M%S"
+END_TIME_FORMAT = "%H%M%S"
+TIME_RANGE_FORMAT = "{}~{}"
+
+# read_recent_logs가 파일 끝에서부터 읽는 단위
+TAIL_CHUNK_SIZE = 64 * 1024
+
+def _hms_after(dt: datetime, seconds: int) -> str:
+    """dt로부터 seconds초 뒤의 HHMMSS 문자열 (datetime 생성 없이 계산)"""
+    total = (dt.hour * 3600 + dt.minute * 60 + dt.second + seconds) % 86400
+    return "%02d%02d%02d" % (total // 3600, total // 60 % 60, total % 60)
+
+def _has_non_finite(obj) -> bool:
+    """NaN / Infinity float 포함 여부"""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(k) or _has_non_finite(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(v) for v in obj)
+    return False
+
+def _json_dumps(obj) -> str:
+    """json.dumps 직렬화 (orjson과 같은 공백 없는 구분자 사용)"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _orjson_dumps(obj) -> Optional[bytes]:
+    """orjson 직렬화, orjson으로 값을 그대로 쓸 수 없으면 None 반환"""
+    if orjson is None:
+        return None
+    # orjson은 NaN / Infinity를 null로 바꿔 쓰므로 json.dumps에 맡김
+    if _has_non_finite(obj):
+        return None
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # orjson이 지원하지 않는 타입 (json.dumps에 맡김)
+        return None
+
+def _dumps_bbox_info(bbox_info: Dict) -> str:
+    """bbox 정보 직렬화 (orjson이 있으면 사용)"""
+    data = _orjson_dumps(bbox_info)
+    if data is not None:
+        return data.decode()
+    return _json_dumps(bbox_info)
+
+def _dumps_entry(time_range: str, description: str, bbox_info: Optional[Dict]) -> bytes:
+    """JSONL 로그 항목 직렬화"""
+    entry = {"t": time_range, "d": description, "b": bbox_info}
+    data = _orjson_dumps(entry)
+    if data is not None:
+        return data + b"\n"
+    return (_json_dumps(entry) + "\n").encode("utf8")
+
+# 종료 시 닫을 LogManager 인스턴스 (약한 참조라 GC와 __del__을 막지 않음)
+_instances = weakref.WeakSet()
+
+@atexit.register
+def _close_all():
+    for manager in list(_instances):
+        manager.close()
+
 class LogManager:
     """로그 관리 클래스"""
     
-    def __init__(self, log_file_path: Path):
+    def __init__(self, log_file_path: Path, flush_every: int = 32, flush_interval: float = 1.0):
         self.log_file_path = log_file_path
         
+        # 확장자가 .jsonl이면 JSONL, 그 외에는 기존 TSV 포맷
+        self.jsonl = self.log_file_path.suffix == JSONL_SUFFIX
+        
+        # flush_every개 항목 또는 flush_interval초마다 flush + fsync
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        
+        self._lock = threading.Lock()
+        self._fh = None
+        self._pending = 0
+        self._flush_timer = None
+        
+        # 로그 항목 수 (처음 필요할 때 계산, 이후 append마다 증가)
+        # "항목수 파일크기" 형식의 .count 파일에 저장해 재시작 시 전체 스캔을 피함
+        self._count_path = self.log_file_path.with_name(self.log_file_path.name + ".count")
+        self._entry_count = None
+        
         # 로그 파일 디렉토리 생성
         self.log_file_path.parent.mkdir(exist_ok=True)
         
         # 로그 파일이 없으면 헤더 생성
         if not self.log_file_path.exists():
             self._create_log_file()
+        
+        # 로그 파일 핸들 유지 (항목마다 open/close 하지 않음)
+        self._open()
+        _instances.add(self)
+    
+    def __del__(self):
+        self.close()
+    
+    def _open(self):
+        """추가 모드로 로그 파일 열기 (바이너리, 라인은 직접 인코딩)"""
+        self._fh = self.log_file_path.open("ab", buffering=1 << 16)
+    
+    def _flush_locked(self):
+        """버퍼 flush + fsync (lock 보유 상태에서 호출)"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._fh is None or self._pending == 0:
+            return
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._pending = 0
+        if self._entry_count is not None:
+            self._save_entry_count(os.fstat(self._fh.fileno()).st_size)
+    
+    def _save_entry_count(self, file_size: int):
+        """항목 수를 파일 크기와 함께 .count 파일에 저장"""
+        try:
+            self._count_path.write_text(f"{self._entry_count} {file_size}", encoding="utf8")
+        except OSError:
+            pass
+    
+    def _get_entry_count_locked(self, file_size: int) -> int:
+        """로그 항목 수 반환 (lock 보유 상태에서 호출)"""
+        if self._entry_count is not None:
+            return self._entry_count
+        
+        # .count 파일이 현재 로그 파일 크기와 일치하면 그대로 사용
+        try:
+            count, saved_size = map(int, self._count_path.read_text(encoding="utf8").split())
+            if saved_size == file_size:
+                self._entry_count = count
+                return count
+        except (OSError, ValueError):
+            pass
+        
+        # 전체 스캔 (바이트 단위 비교로 디코딩 생략)
+        with self.log_file_path.open("rb") as f:
+            self._entry_count = sum(1 for line in f if line[:1] != b'#' and line.strip())
+        self._save_entry_count(file_size)
+        return self._entry_count
+    
+    def flush(self):
+        """대기 중인 로그 항목을 디스크에 기록"""
+        with self._lock:
+            self._flush_locked()
+    
+    def close(self):
+        """로그 파일 핸들 닫기"""
+        lock = getattr(self, "_lock", None)
+        if lock is None:
+            return
+        with lock:
+            self._flush_locked()
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
     
     def _create_log_file(self):
-        """로그 파일 생성 및 헤더 추가"""
+        """로그 파일 생성 및 헤더 추가 (JSONL은 헤더 없이 빈 파일)"""
         try:
             with self.log_file_path.open("w", encoding="utf8") as f:
-                f.write("# Action Log File\n")
-                f.write("# Format: TIME_RANGE\\tDESCRIPTION\\tBBOX_INFO\n")
-                f.write("# Created: " + datetime.now().isoformat() + "\n")
-                f.write("\n")
-            print(f"📝 로그 파일 생성: {self.log_file_path}")
+                if not self.jsonl:
+                    f.write("# Action Log File\n")
+                    f.write("# Format: TIME_RANGE\\tDESCRIPTION\\tBBOX_INFO\n")
+                    f.write("# Created: " + datetime.now().isoformat() + "\n")
+                    f.write("\n")
+            logger.info("📝 로그 파일 생성: %s", self.log_file_path)
         except Exception as e:
-            print(f"❌ 로그 파일 생성 실패: {e}")
+            logger.error("❌ 로그 파일 생성 실패: %s", e)
     
     def append_log(self, start_dt: datetime, end_dt: datetime, description: str, bbox_info: Optional[Dict] = None) -> bool:
         """로그 항목 추가"""
+        time_range = TIME_RANGE_FORMAT.format(start_dt.strftime(START_TIME_FORMAT), end_dt.strftime(END_TIME_FORMAT))
+        return self._append_entry(time_range, description, bbox_info)
+    
+    def _append_entry(self, time_range: str, description: str, bbox_info: Optional[Dict] = None) -> bool:
+        """포맷된 시간 범위로 로그 항목 추가"""
         try:
-            # 시간 범위 포맷
-            time_range = f"{start_dt.strftime('%Y-%m-%d-%H%M%S')}~{end_dt.strftime('%H%M%S')}"
-            
-            # 로그 데이터 구성
-            log_data = {
-                'time_range': time_range,
-                'description': description,
-                'bbox_info': bbox_info,
-                'timestamp': datetime.now().isoformat()
-            }
+            # 파일에 추가 (버퍼링 후 주기적으로 flush)
+            if self.jsonl:
+                line = _dumps_entry(time_range, description, bbox_info)
+            elif bbox_info:
+                line = LOG_LINE_FORMAT.format(time_range, description, _dumps_bbox_info(bbox_info)).encode("utf8")
+            else:
+                line = LOG_LINE_FORMAT_NO_BBOX.format(time_range, description).encode("utf8")
             
-            # 파일에 추가
-            with self.log_file_path.open("a", encoding="utf8") as f:
-                if bbox_info:
-                    f.write(f"{time_range}\t{description}\t{json.dumps(bbox_info, ensure_ascii=False)}\n")
-                else:
-                    f.write(f"{time_range}\t{description}\n")
+            with self._lock:
+                if self._fh is None:
+                    self._open()
+                self._fh.write(line)
+                self._pending += 1
+                if self._entry_count is not None:
+                    self._entry_count += 1
+                if self._pending >= self.flush_every:
+                    self._flush_locked()
+                elif self._flush_timer is None:
+                    # 추가 항목이 없어도 flush_interval 안에 기록되도록 예약
+                    self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
             
-            print(f"📝 로그 저장 완료: {description}")
+            logger.debug("📝 로그 저장 완료: %s", description)
             return True
             
         except Exception as e:
-            print(f"❌ 로그 저장 실패: {e}")
+            logger.error("❌ 로그 저장 실패: %s", e)
             return False
     
     def log_analysis_result(self, video_path: Path, bbox_normalized: List[float], 
@@ -67,7 +248,7 @@ class LogManager:
                           duration_sec: int = 5) -> bool:
         """분석 결과 로그"""
         start_dt = datetime.now()
-        end_dt = start_dt + timedelta(seconds=duration_sec)
+        time_range = TIME_RANGE_FORMAT.format(start_dt.strftime(START_TIME_FORMAT), _hms_after(start_dt, duration_sec))
         
         bbox_info = {
             'bbox_normalized': bbox_normalized,
@@ -76,13 +257,13 @@ class LogManager:
             'duration_sec': duration_sec
         }
         
-        return self.append_log(start_dt, end_dt, description, bbox_info)
+        return self._append_entry(time_range, description, bbox_info)
     
     def log_api_trigger(self, signal_type: str, bbox_normalized: List[float], 
                        metadata: Dict, description: str = None) -> bool:
         """API 트리거 로그"""
         start_dt = datetime.now()
-        end_dt = start_dt + timedelta(seconds=1)
+        time_range = TIME_RANGE_FORMAT.format(start_dt.strftime(START_TIME_FORMAT), _hms_after(start_dt, 1))
         
         log_description = description or f"API trigger: {signal_type}"
         
@@ -93,83 +274,121 @@ class LogManager:
             'source': 'api_trigger'
         }
         
-        return self.append_log(start_dt, end_dt, log_description, bbox_info)
+        return self._append_entry(time_range, log_description, bbox_info)
     
     def read_recent_logs(self, count: int = 10) -> List[str]:
         """최근 로그 읽기"""
         try:
+            self.flush()
+            
             if not self.log_file_path.exists():
                 return []
             
-            with self.log_file_path.open("r", encoding="utf8") as f:
-                lines = f.readlines()
+            if count <= 0:
+                return []
             
-            # 주석이 아닌 라인만 필터링
-            log_lines = [line.strip() for line in lines if line.strip() and not line.startswith('#')]
+            # 파일 끝에서부터 청크 단위로 읽어 count개 라인을 모을 때까지만 진행
+            log_lines = []
+            with self.log_file_path.open("rb") as f:
+                pos = f.seek(0, os.SEEK_END)
+                remainder = b""
+                while pos > 0 and len(log_lines) < count:
+                    read_size = min(TAIL_CHUNK_SIZE, pos)
+                    pos -= read_size
+                    f.seek(pos)
+                    lines = (f.read(read_size) + remainder).split(b"\n")
+                    # 첫 조각은 앞 청크와 이어질 수 있으므로 다음 반복으로 넘김
+                    remainder = lines.pop(0) if pos > 0 else b""
+                    for line in reversed(lines):
+                        # 주석이 아닌 라인만 필터링 (바이트 단위 비교)
+                        line = line.strip()
+                        if line and line[:1] != b'#':
+                            log_lines.append(line)
+                            if len(log_lines) == count:
+                                break
             
-            # 최근 count개 반환
-            return log_lines[-count:] if log_lines else []
+            # 최근 count개를 오래된 순서로 반환
+            return [line.decode("utf8") for line in reversed(log_lines)]
             
         except Exception as e:
-            print(f"❌ 로그 읽기 실패: {e}")
+            logger.error("❌ 로그 읽기 실패: %s", e)
             return []
     
     def get_log_stats(self) -> Dict:
         """로그 통계 정보"""
         try:
-            if not self.log_file_path.exists():
-                return {"total_entries": 0, "file_size": 0}
-            
-            # 파일 크기
-            file_size = self.log_file_path.stat().st_size
-            
-            # 로그 항목 수 계산
-            with self.log_file_path.open("r", encoding="utf8") as f:
-                lines = f.readlines()
-            
-            log_entries = len([line for line in lines if line.strip() and not line.startswith('#')])
+            with self._lock:
+                self._flush_locked()
+                
+                if not self.log_file_path.exists():
+                    return {"total_entries": 0, "file_size": 0}
+                
+                # 파일 크기 / 수정 시각
+                stat = self.log_file_path.stat()
+                
+                # 로그 항목 수
+                log_entries = self._get_entry_count_locked(stat.st_size)
             
             return {
                 "total_entries": log_entries,
-                "file_size": file_size,
+                "file_size": stat.st_size,
                 "file_path": str(self.log_file_path),
-                "last_modified": datetime.fromtimestamp(self.log_file_path.stat().st_mtime).isoformat()
+                "last_modified": datetime.fromtimestamp(stat.st_mtime).isoformat()
             }
             
         except Exception as e:
-            print(f"❌ 로그 통계 조회 실패: {e}")
+            logger.error("❌ 로그 통계 조회 실패: %s", e)
             return {"error": str(e)}
     
     def clear_logs(self) -> bool:
         """로그 파일 초기화"""
         try:
-            self._create_log_file()
-            print("🗑️ 로그 파일 초기화 완료")
+            with self._lock:
+                self._flush_locked()
+                if self._fh is not None:
+                    self._fh.close()
+                self._create_log_file()
+                self._open()
+                self._entry_count = 0
+                self._save_entry_count(self.log_file_path.stat().st_size)
+            logger.info("🗑️ 로그 파일 초기화 완료")
             return True
         except Exception as e:
-            print(f"❌ 로그 파일 초기화 실패: {e}")
+            logger.error("❌ 로그 파일 초기화 실패: %s", e)
             return False
     
-    def backup_logs(self, backup_suffix: str = None) -> Optional[Path]:
-        """로그 파일 백업"""
+    def backup_logs(self, backup_suffix: str = None, compress: bool = False) -> Optional[Path]:
+        """로그 파일 백업 (compress=True이면 zstd 압축, zstandard 필요)"""
         try:
+            self.flush()
+            
             if not self.log_file_path.exists():
-                print("❌ 백업할 로그 파일이 없습니다.")
+                logger.error("❌ 백업할 로그 파일이 없습니다.")
                 return None
             
             # 백업 파일명 생성
             if backup_suffix is None:
                 backup_suffix = datetime.now().strftime("%Y%m%d_%H%M%S")
             
-            backup_path = self.log_file_path.with_suffix(f".{backup_suffix}.txt")
+            backup_path = self.log_file_path.with_suffix(f".{backup_suffix}{self.log_file_path.suffix}")
+            
+            if compress and zstandard is None:
+                logger.warning("⚠️ zstandard가 설치되지 않아 압축 없이 백업합니다.")
+                compress = False
             
-            # 파일 복사
-            import shutil
-            shutil.copy2(self.log_file_path, backup_path)
+            if compress:
+                # zstd 스트림 압축
+                backup_path = backup_path.with_name(backup_path.name + ".zst")
+                with self.log_file_path.open("rb") as src, backup_path.open("wb") as dst:
+                    zstandard.ZstdCompressor().copy_stream(src, dst)
+            else:
+                # 파일 복사
+                import shutil
+                shutil.copy2(self.log_file_path, backup_path)
             
-            print(f"💾 로그 백업 완료: {backup_path}")
+            logger.info("💾 로그 백업 완료: %s", backup_path)
             return backup_path
             
         except Exception as e:
-            print(f"❌ 로그 백업 실패: {e}")
+            logger.error("❌ 로그 백업 실패: %s", e)
             return None 
\ No newline at end of file